@@ -228,7 +228,11 @@ class BaseRecommender(RecommenderCommons, IsSavable, ABC):
             k=k,
         )
 
-        self.study.optimize(objective, budget)
+        try:
+            self.study.optimize(objective, budget)
+        finally:
+            split_data.queries.unpersist()
+            split_data.items.unpersist()
         best_params = self.study.best_params
         self.set_params(**best_params)
         return best_params
@@ -336,8 +340,8 @@ class BaseRecommender(RecommenderCommons, IsSavable, ABC):
         """
         train = self._filter_dataset_features(train_dataset)
         test = self._filter_dataset_features(test_dataset)
-        queries = test_dataset.interactions.select(self.query_column).distinct()
-        items = test_dataset.interactions.select(self.item_column).distinct()
+        queries = test_dataset.interactions.select(self.query_column).distinct().cache()
+        items = test_dataset.interactions.select(self.item_column).distinct().cache()
         split_data = SplitData(
             train,
             test,
@@ -419,14 +423,14 @@ class BaseRecommender(RecommenderCommons, IsSavable, ABC):
             )
         self.fit_queries = sf.broadcast(queries)
         self.fit_items = sf.broadcast(items)
-        self._num_queries = self.fit_queries.count()
-        self._num_items = self.fit_items.count()
-        self._query_dim_size = (
-            self.fit_queries.agg({self.query_column: "max"}).collect()[0][0] + 1
-        )
-        self._item_dim_size = (
-            self.fit_items.agg({self.item_column: "max"}).collect()[0][0] + 1
-        )
+        self._num_queries, max_query = self.fit_queries.agg(
+            sf.count(sf.lit(1)), sf.max(self.query_column)
+        ).first()
+        self._num_items, max_item = self.fit_items.agg(
+            sf.count(sf.lit(1)), sf.max(self.item_column)
+        ).first()
+        self._query_dim_size = max_query + 1
+        self._item_dim_size = max_item + 1
         self._fit(dataset)
 
     @abstractmethod
@@ -3,6 +3,8 @@ This splitter split data by two columns.
 """
 from typing import Optional, Union
 
+import numpy as np
+
 from replay.splitters.base_splitter import Splitter, SplitterReturnType
 from replay.utils import PYSPARK_AVAILABLE, DataFrameLike, PandasDataFrame, SparkDataFrame
 
@@ -114,56 +116,52 @@ class TwoStageSplitter(Splitter):
         self.shuffle = shuffle
         self.seed = seed
 
-    def _get_test_values(
-        self,
-        interactions: DataFrameLike,
-    ) -> DataFrameLike:
+    def _check_first_divide_size(self, values_count: Optional[int] = None) -> None:
         """
-        :param interactions: input DataFrame
-        :return: Spark DataFrame with single column `first_divide_column`
+        :param values_count: number of distinct values of `first_divide_column`,
+            needed only for an integer `first_divide_size`
         """
-        if isinstance(interactions, SparkDataFrame):
-            all_values = interactions.select(self.first_divide_column).distinct()
-            user_count = all_values.count()
-        else:
-            all_values = PandasDataFrame(
-                interactions[self.first_divide_column].unique(), columns=[self.first_divide_column]
-            )
-            user_count = len(all_values)
-
-        value_error = False
         if isinstance(self.first_divide_size, int):
-            if 1 <= self.first_divide_size < user_count:
-                test_user_count = self.first_divide_size
-            else:
-                value_error = True
+            is_valid = 1 <= self.first_divide_size < values_count
         else:
-            if 1 > self.first_divide_size > 0:
-                test_user_count = user_count * self.first_divide_size
-            else:
-                value_error = True
-        if value_error:
+            is_valid = 1 > self.first_divide_size > 0
+        if not is_valid:
             raise ValueError(
                 f"""
             Invalid value for user_test_size: {self.first_divide_size}
             """
             )
+
+    def _get_test_values_count(self, values_count: int) -> float:
+        """
+        :param values_count: number of distinct values of `first_divide_column`
+        :return: number of values to take to the test split
+        """
+        self._check_first_divide_size(values_count)
+        if isinstance(self.first_divide_size, int):
+            return self.first_divide_size
+        return values_count * self.first_divide_size
+
+    def _get_test_values(
+        self,
+        interactions: DataFrameLike,
+    ) -> DataFrameLike:
+        """
+        :param interactions: input DataFrame
+        :return: Spark DataFrame with single column `first_divide_column`
+        """
         if isinstance(interactions, SparkDataFrame):
-            test_users = (
-                all_values.withColumn("_rand", sf.rand(self.seed))
-                .withColumn(
-                    "_row_num", sf.row_number().over(Window.orderBy("_rand"))
-                )
-                .filter(f"_row_num <= {test_user_count}")
-                .drop("_rand", "_row_num")
-            )
-        else:
-            test_users = all_values.sample(n=int(test_user_count), random_state=self.seed)
+            all_values = interactions.select(self.first_divide_column).distinct()
+            test_user_count = self._get_test_values_count(all_values.count())
+            return all_values.orderBy(sf.rand(self.seed)).limit(int(test_user_count))
 
-        return test_users
+        all_values = PandasDataFrame(
+            interactions[self.first_divide_column].unique(), columns=[self.first_divide_column]
+        )
+        test_user_count = self._get_test_values_count(len(all_values))
+        return all_values.sample(n=int(test_user_count), random_state=self.seed)
 
     def _split_proportion_spark(self, interactions: SparkDataFrame) -> Union[SparkDataFrame, SparkDataFrame]:
-        counts = interactions.groupBy(self.first_divide_column).count()
         test_users = self._get_test_values(interactions).withColumn(
             "is_test", sf.lit(True)
         )
@@ -177,29 +175,21 @@ class TwoStageSplitter(Splitter):
                 query_column=self.query_column,
             )
 
-        res = res.join(counts, on=self.first_divide_column, how="left")
+        res = res.withColumn(
+            "count", sf.count(sf.lit(1)).over(Window.partitionBy(self.first_divide_column))
+        )
         res = res.withColumn("_frac", sf.col("_row_num") / sf.col("count"))
         res = res.na.fill({"is_test": False})
+        res = res.withColumn(
+            "is_test", sf.col("is_test") & (sf.col("_frac") <= sf.lit(self.second_divide_size))
+        )
 
-        train = res.filter(
-            f"""
-                    _frac > {self.second_divide_size} OR
-                    NOT is_test
-                """
-        ).drop("_rand", "_row_num", "count", "_frac", "is_test")
-        test = res.filter(
-            f"""
-                    _frac <= {self.second_divide_size} AND
-                    is_test
-                """
-        ).drop("_rand", "_row_num", "count", "_frac", "is_test")
+        train = res.filter(~sf.col("is_test")).select(*interactions.columns)
+        test = res.filter(sf.col("is_test")).select(*interactions.columns)
 
         return train, test
 
     def _split_proportion_pandas(self, interactions: PandasDataFrame) -> Union[PandasDataFrame, PandasDataFrame]:
-        counts = interactions.groupby(self.first_divide_column).agg(
-            count=(self.first_divide_column, "count")
-        ).reset_index()
         test_users = self._get_test_values(interactions)
         test_users["is_test"] = True
         if self.shuffle:
@@ -212,14 +202,12 @@ class TwoStageSplitter(Splitter):
                 query_column=self.query_column,
             )
         res["is_test"].fillna(False, inplace=True)
-        res = res.merge(counts, on=self.first_divide_column, how="left")
+        res = res.reset_index(drop=True)
+        res["count"] = res.groupby(self.first_divide_column)[self.first_divide_column].transform("count")
         res["_frac"] = res["_row_num"] / res["count"]
-        train = res[(res["_frac"] > self.second_divide_size) | (~res["is_test"])].drop(
-            columns=["_row_num", "count", "_frac", "is_test"]
-        )
-        test = res[(res["_frac"] <= self.second_divide_size) & (res["is_test"])].drop(
-            columns=["_row_num", "count", "_frac", "is_test"]
-        )
+        res["is_test"] = res["is_test"] & (res["_frac"] <= self.second_divide_size)
+        train = res[~res["is_test"]].drop(columns=["_row_num", "count", "_frac", "is_test"])
+        test = res[res["is_test"]].drop(columns=["_row_num", "count", "_frac", "is_test"])
 
         return train, test
 
@@ -239,28 +227,31 @@ class TwoStageSplitter(Splitter):
         test_users = self._get_test_values(interactions).withColumn(
             "is_test", sf.lit(True)
         )
+        res = interactions.join(test_users, how="left", on=self.first_divide_column)
         if self.shuffle:
-            res = self._add_random_partition_spark(
-                interactions.join(test_users, how="left", on=self.first_divide_column)
-            )
+            # `_rand` is drawn before filtering, so a seed gives the same ranks as on the whole log
+            res = res.withColumn("_rand", sf.rand(self.seed))
+        train = None
+        ranked = res
+        # When the window is keyed by the first divide column, rows of values
+        # that are not in test skip the window and go to train as they are.
+        if self.shuffle or self.query_column == self.first_divide_column:
+            train = res.filter(sf.col("is_test").isNull()).select(*interactions.columns)
+            ranked = res.filter(sf.col("is_test").isNotNull())
+        if self.shuffle:
+            ranked = self._add_random_partition_spark(ranked)
         else:
-            res = self._add_time_partition_spark(
-                interactions.join(test_users, how="left", on=self.first_divide_column),
+            ranked = self._add_time_partition_spark(
+                ranked,
                 query_column=self.query_column,
             )
-        res = res.na.fill({"is_test": False})
-        train = res.filter(
-            f"""
-                    _row_num > {self.second_divide_size} OR
-                    NOT is_test
-                """
-        ).drop("_rand", "_row_num", "is_test")
-        test = res.filter(
-            f"""
-                    _row_num <= {self.second_divide_size} AND
-                    is_test
-                """
-        ).drop("_rand", "_row_num", "is_test")
+        ranked_train = ranked.filter(
+            (sf.col("_row_num") > self.second_divide_size) | sf.col("is_test").isNull()
+        ).select(*interactions.columns)
+        train = ranked_train if train is None else train.union(ranked_train)
+        test = ranked.filter(
+            (sf.col("_row_num") <= self.second_divide_size) & sf.col("is_test").isNotNull()
+        ).select(*interactions.columns)
 
         return train, test
 
@@ -299,7 +290,18 @@ class TwoStageSplitter(Splitter):
             return self._split_quantity_pandas(interactions)
 
     def _core_split(self, interactions: DataFrameLike) -> SplitterReturnType:
-        if 0 <= self.second_divide_size < 1.0:
+        if self.second_divide_size == 0:
+            values_count = None
+            if isinstance(self.first_divide_size, int):
+                if isinstance(interactions, SparkDataFrame):
+                    values_count = interactions.select(self.first_divide_column).distinct().count()
+                else:
+                    values_count = interactions[self.first_divide_column].nunique()
+            self._check_first_divide_size(values_count)
+            if isinstance(interactions, SparkDataFrame):
+                return interactions, interactions.limit(0)
+            return interactions.copy(), interactions.iloc[:0]
+        if 0 < self.second_divide_size < 1.0:
             train, test = self._split_proportion(interactions)
         elif self.second_divide_size >= 1 and isinstance(self.second_divide_size, int):
             train, test = self._split_quantity(interactions)
@@ -315,11 +317,13 @@ class TwoStageSplitter(Splitter):
     def _add_random_partition_spark(self, dataframe: SparkDataFrame) -> SparkDataFrame:
         """
         Adds `_rand` column and a user index column `_row_num` based on `_rand`.
+        An existing `_rand` column is kept.
 
         :param dataframe: input DataFrame with `query_id` column
         :returns: processed DataFrame
         """
-        dataframe = dataframe.withColumn("_rand", sf.rand(self.seed))
+        if "_rand" not in dataframe.columns:
+            dataframe = dataframe.withColumn("_rand", sf.rand(self.seed))
         dataframe = dataframe.withColumn(
             "_row_num",
             sf.row_number().over(
@@ -330,10 +334,24 @@ class TwoStageSplitter(Splitter):
 
     def _add_random_partition_pandas(self, dataframe: PandasDataFrame) -> PandasDataFrame:
         res = dataframe.sample(frac=1, random_state=self.seed).sort_values(self.first_divide_column)
-        res["_row_num"] = res.groupby(self.first_divide_column, sort=False).cumcount() + 1
+        res["_row_num"] = self._sorted_group_row_numbers(res[self.first_divide_column].to_numpy())
 
         return res
 
+    @staticmethod
+    def _sorted_group_row_numbers(values: np.ndarray) -> np.ndarray:
+        """
+        Numbers rows inside runs of equal consecutive values, starting from 1.
+
+        :param values: group keys of a DataFrame sorted by them
+        :returns: row number of every row inside its group
+        """
+        is_start = np.ones(len(values), dtype=bool)
+        is_start[1:] = values[1:] != values[:-1]
+        starts = np.flatnonzero(is_start)
+        group_sizes = np.diff(np.append(starts, len(values)))
+        return np.arange(1, len(values) + 1) - np.repeat(starts, group_sizes)
+
     @staticmethod
     def _add_time_partition_spark(
             dataframe: SparkDataFrame,
@@ -366,5 +384,5 @@ class TwoStageSplitter(Splitter):
     ) -> PandasDataFrame:
         res = dataframe.copy(deep=True)
         res.sort_values([query_column, date_column], ascending=[True, False], inplace=True)
-        res["_row_num"] = res.groupby(query_column, sort=False).cumcount() + 1
+        res["_row_num"] = TwoStageSplitter._sorted_group_row_numbers(res[query_column].to_numpy())
         return res
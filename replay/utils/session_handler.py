@@ -28,7 +28,8 @@ def get_spark_session(
 
     :param spark_memory: GB of memory allocated for Spark;
         70% of RAM by default.
-    :param shuffle_partitions: number of partitions for Spark; triple CPU count by default
+    :param shuffle_partitions: number of partitions for Spark; triple CPU count by default.
+        Adaptive query execution coalesces small shuffle partitions at runtime.
     """
     if os.environ.get("SCRIPT_ENV", None) == "cluster":
         # pylint: disable=no-member
@@ -70,6 +71,8 @@ def get_spark_session(
         )
         .config("spark.jars", path_to_replay_jar)
         .config("spark.sql.shuffle.partitions", str(shuffle_partitions))
+        .config("spark.sql.adaptive.enabled", "true")
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true")
         .config("spark.local.dir", os.path.join(user_home, "tmp"))
         .config("spark.driver.maxResultSize", "4g")
         .config("spark.driver.bindAddress", "127.0.0.1")
@@ -275,3 +275,98 @@ def test_split_proportion(dataset_type, request):
     else:
         num_items = test.toPandas().user_id.value_counts()
         assert num_items[0] == 1
+
+
+@pytest.mark.parametrize(
+    "dataset_type",
+    [
+        pytest.param("log2", marks=pytest.mark.spark),
+        pytest.param("log2_pandas", marks=pytest.mark.core),
+    ]
+)
+def test_zero_second_divide_size(dataset_type, request):
+    log2 = request.getfixturevalue(dataset_type)
+    splitter = TwoStageSplitter(
+        first_divide_size=1,
+        second_divide_size=0,
+        first_divide_column="user_id",
+        query_column="user_id",
+    )
+    train, test = splitter.split(log2)
+    if isinstance(log2, pd.DataFrame):
+        assert train.shape[0] == log2.shape[0]
+        assert test.shape[0] == 0
+        assert list(test.columns) == list(log2.columns)
+    else:
+        assert train.count() == log2.count()
+        assert test.count() == 0
+        assert test.columns == log2.columns
+
+
+@pytest.mark.parametrize("first_divide_size", [5, 1.0, 0])
+@pytest.mark.parametrize(
+    "dataset_type",
+    [
+        pytest.param("log2", marks=pytest.mark.spark),
+        pytest.param("log2_pandas", marks=pytest.mark.core),
+    ]
+)
+def test_zero_second_divide_size_invalid_first_divide_size(first_divide_size, dataset_type, request):
+    log2 = request.getfixturevalue(dataset_type)
+    splitter = TwoStageSplitter(
+        first_divide_size=first_divide_size,
+        second_divide_size=0,
+        first_divide_column="user_id",
+        query_column="user_id",
+    )
+    with pytest.raises(ValueError):
+        splitter.split(log2)
+
+
+log3_data = [
+    [1, 10, 5],
+    [1, 20, 4],
+    [1, 20, 3],
+    [2, 20, 5],
+    [2, 10, 4],
+    [2, 10, 3],
+]
+
+
+@pytest.fixture
+def log3(spark):
+    return spark.createDataFrame(log3_data, schema=["user_id", "item_id", "timestamp"])
+
+
+@pytest.fixture
+def log3_pandas():
+    return PandasDataFrame(log3_data, columns=["user_id", "item_id", "timestamp"])
+
+
+@pytest.mark.parametrize(
+    "dataset_type",
+    [
+        pytest.param("log3", marks=pytest.mark.spark),
+        pytest.param("log3_pandas", marks=pytest.mark.core),
+    ]
+)
+def test_split_quantity_ranks_by_query(dataset_type, request):
+    log3 = request.getfixturevalue(dataset_type)
+    splitter = TwoStageSplitter(
+        first_divide_size=1,
+        second_divide_size=1,
+        first_divide_column="item_id",
+        query_column="user_id",
+        seed=1234,
+    )
+    train, test = splitter.split(log3)
+    if not isinstance(log3, pd.DataFrame):
+        train = train.toPandas()
+        test = test.toPandas()
+        log3 = log3.toPandas()
+
+    # whichever item goes to test, only the latest interaction of one user may be taken
+    assert test.shape[0] == 1
+    assert train.shape[0] + test.shape[0] == log3.shape[0]
+    latest = log3.groupby("user_id")["timestamp"].transform("max") == log3["timestamp"]
+    assert len(test.merge(log3[latest], on=["user_id", "item_id", "timestamp"])) == 1